@@ -0,0 +1,205 @@
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bucket_zip
+
+
+class FakeBlob:
+    """The parts of google.cloud.storage.Blob that the upload code uses, backed by FakeBucket."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+
+    def upload_from_file(self, file_obj, size=None, checksum=None, content_type=None, if_generation_match=None):
+        self.bucket.put(self.name, file_obj.read(size), if_generation_match)
+
+    def compose(self, sources, if_generation_match=None):
+        self.bucket.put(self.name, b''.join(self.bucket.objects[source.name] for source in sources), if_generation_match)
+
+
+class FakeBucket:
+    """In-memory stand-in for a GCS bucket."""
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def put(self, name, data, if_generation_match=None):
+        with self.lock:
+            if if_generation_match == 0 and name in self.objects:
+                raise ValueError(f"{name} already exists")
+            self.objects[name] = bytes(data)
+
+    def delete_blobs(self, blobs, on_error=None):
+        with self.lock:
+            for blob in blobs:
+                self.objects.pop(blob.name, None)
+
+
+class CompositeUploadWriterTest(unittest.TestCase):
+    PART_SIZE = 16
+
+    def setUp(self):
+        self.bucket = FakeBucket()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.executor.shutdown)
+
+    def upload(self, data):
+        writer = bucket_zip.CompositeUploadWriter(self.bucket.blob('chunk.zip'), 'application/zip',
+                                                  bucket_zip.BufferPool(self.PART_SIZE, 6), self.executor)
+        # Uneven writes, so parts are filled across write() calls
+        for i in range(0, len(data), 7):
+            writer.write(data[i:i + 7])
+        writer.close()
+
+    def check_upload(self, part_count):
+        data = bytes(i % 251 for i in range(part_count * self.PART_SIZE - 3))
+        self.upload(data)
+        # Only the destination remains, with the bytes in order and nothing composed twice
+        self.assertEqual(list(self.bucket.objects), ['chunk.zip'])
+        self.assertEqual(self.bucket.objects['chunk.zip'], data)
+
+    def test_single_part_is_uploaded_directly(self):
+        self.check_upload(1)
+
+    def test_parts_compose_in_one_request(self):
+        self.check_upload(bucket_zip.MAX_COMPOSE_SOURCES)
+
+    def test_parts_compose_in_two_rounds(self):
+        self.check_upload(bucket_zip.MAX_COMPOSE_SOURCES + 8)
+
+    def test_parts_compose_in_three_rounds(self):
+        self.check_upload(bucket_zip.MAX_COMPOSE_SOURCES ** 2 + 1)
+
+
+class UnseekableBuffer(io.RawIOBase):
+    """Collects written bytes without supporting seek(), like the upload stream a chunk is zipped into."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+class ZipEntryTest(unittest.TestCase):
+    """Entries are written with zipfile internals, so pin that what comes out is a valid, bounded zip."""
+
+    DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+    def setUp(self):
+        random.seed(0)
+        self.files = {
+            'empty.txt': b'',
+            'text/lorem.txt': b'lorem ipsum dolor sit amet ' * 2000,
+            'random.bin': bytes(random.getrandbits(8) for _ in range(70000)),
+            'unicode/\u00e9t\u00e9.csv': b'a,b\n1,2\n' * 500,
+        }
+        self.staging_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.staging_dir)
+
+    def stage(self, name, data, as_record, compress_type, compresslevel):
+        if as_record:
+            return bucket_zip.ZipRecord(name, io.BytesIO(data), compress_type, compresslevel)
+        path = os.path.join(self.staging_dir, str(len(os.listdir(self.staging_dir))))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def build_chunk(self, compression, compresslevel, as_record):
+        zip_writer = bucket_zip.CountingWriter(UnseekableBuffer())
+        zip_file = zipfile.ZipFile(zip_writer, 'w', compression, allowZip64=True, compresslevel=compresslevel)
+        total_bound = bucket_zip.ZIP_END_RECORDS_SIZE
+        for name, data in self.files.items():
+            staged = self.stage(name, data, as_record, compression, compresslevel)
+            bound = bucket_zip.get_entry_size_bound(name, staged, compression)
+            start = zip_writer.tell()
+            bucket_zip.add_to_zip(zip_file, name, staged, bytearray(4096), compression)
+            self.assertLessEqual(zip_writer.tell() - start + bucket_zip.get_central_record_size(name), bound, name)
+            total_bound += bound
+        zip_file.close()
+        chunk = bytes(zip_writer.sink.data)
+        # The central directory and end records fit in what the bounds set aside for them
+        self.assertLessEqual(len(chunk), total_bound)
+        return chunk
+
+    def check_round_trip(self, chunk):
+        with zipfile.ZipFile(io.BytesIO(chunk)) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.namelist(), list(self.files))
+            for name, data in self.files.items():
+                self.assertEqual(zip_file.read(name), data, name)
+
+    def test_round_trip(self):
+        for compression, compresslevel in ((zipfile.ZIP_STORED, None), (zipfile.ZIP_DEFLATED, 0),
+                                           (zipfile.ZIP_DEFLATED, 1), (zipfile.ZIP_DEFLATED, 6),
+                                           (zipfile.ZIP_DEFLATED, 9), (zipfile.ZIP_DEFLATED, None)):
+            for as_record in (True, False):
+                with self.subTest(compression=compression, compresslevel=compresslevel, as_record=as_record):
+                    self.check_round_trip(self.build_chunk(compression, compresslevel, as_record))
+
+    def test_mixed_entries_round_trip(self):
+        zip_writer = bucket_zip.CountingWriter(UnseekableBuffer())
+        zip_file = zipfile.ZipFile(zip_writer, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=1)
+        for i, (name, data) in enumerate(self.files.items()):
+            compress_type = zipfile.ZIP_STORED if i % 2 else zipfile.ZIP_DEFLATED
+            staged = self.stage(name, data, i < 2, compress_type, 1)
+            bucket_zip.add_to_zip(zip_file, name, staged, bytearray(4096), compress_type)
+        zip_file.close()
+        self.check_round_trip(bytes(zip_writer.sink.data))
+
+    def test_streamed_entry_matches_zipfile(self):
+        # Same bytes as ZipFile.open() writes to an unseekable file, CRC and data descriptor included
+        for compression, compresslevel in ((zipfile.ZIP_STORED, None), (zipfile.ZIP_DEFLATED, 1),
+                                           (zipfile.ZIP_DEFLATED, 9)):
+            with self.subTest(compression=compression, compresslevel=compresslevel):
+                ours = UnseekableBuffer()
+                with zipfile.ZipFile(ours, 'w', compression, allowZip64=True, compresslevel=compresslevel) as zip_file:
+                    for name, data in self.files.items():
+                        zip_info = bucket_zip.new_zip_info(name, compression)
+                        zip_info.date_time = self.DATE_TIME
+                        bucket_zip.write_zip_stream(zip_file, zip_info, io.BytesIO(data), bytearray(4096))
+                expected = UnseekableBuffer()
+                with zipfile.ZipFile(expected, 'w', compression, allowZip64=True, compresslevel=compresslevel) as zip_file:
+                    for name, data in self.files.items():
+                        with zip_file.open(name, 'w', force_zip64=True) as entry:
+                            entry.write(data)
+                self.assertEqual(ours.data, expected.data)
+
+    def test_stored_record_matches_zipfile(self):
+        # Same bytes as ZipFile.writestr() writes to a seekable file, which rewrites the header with the sizes
+        ours = UnseekableBuffer()
+        with zipfile.ZipFile(ours, 'w', allowZip64=True) as zip_file:
+            for name, data in self.files.items():
+                record = bucket_zip.ZipRecord(name, io.BytesIO(data), zipfile.ZIP_STORED, None)
+                record.zip_info.date_time = self.DATE_TIME
+                bucket_zip.write_zip_record(zip_file, record)
+        expected = io.BytesIO()
+        with zipfile.ZipFile(expected, 'w', allowZip64=True) as zip_file:
+            for name, data in self.files.items():
+                zip_info = bucket_zip.new_zip_info(name, zipfile.ZIP_STORED)
+                zip_info.date_time = self.DATE_TIME
+                zip_file.writestr(zip_info, data)
+        self.assertEqual(bytes(ours.data), expected.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()